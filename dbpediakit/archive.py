@@ -106,7 +106,7 @@ def extract_link(archive_filename, max_items=None, predicate_filter=None,
 
 def extract_text(archive_filename, max_items=None, min_length=300,
                  strip_prefix="http://dbpedia.org/resource/",
-                 max_id_length=300):
+                 max_id_length=300, decode=True):
     """Extract and decode text literals on the fly
 
     Return a generator of article(id, title, text) named tuples:
@@ -116,6 +116,10 @@ def extract_text(archive_filename, max_items=None, min_length=300,
     - text is the first paragraph of the Wikipedia article without any markup.
     - lang is the language code of the text literal
 
+    If decode is False, text is returned as a UTF-8 encoded byte string
+    instead of a unicode object, e.g. for direct CSV serialization. In both
+    cases min_length is compared to the number of decoded characters.
+
     """
     reader = BZ2File if archive_filename.endswith('.bz2') else open
 
@@ -142,10 +146,26 @@ def extract_text(archive_filename, max_items=None, min_length=300,
                 logging.warn("Skipping line %d, with id with length %d",
                              current_line_number, len(id))
                 continue
-            title = unquote(id).replace('_', ' ')
-            text = m.group(2).decode('unicode-escape')
+            raw_text = m.group(2)
+            # escape sequences can only make the decoded text shorter
+            if len(raw_text) < min_length:
+                continue
+            is_ascii = False
+            if '\\' not in raw_text:
+                try:
+                    # plain ASCII literal: no escape sequence to decode
+                    text = raw_text.decode('ascii')
+                    is_ascii = True
+                except UnicodeDecodeError:
+                    pass
+            if not is_ascii:
+                text = raw_text.decode('unicode-escape')
             if len(text) < min_length:
                 continue
+            if not decode:
+                # ASCII bytes are valid UTF-8 and can be reused as is
+                text = raw_text if is_ascii else text.encode('utf-8')
+            title = unquote(id).replace('_', ' ')
             lang = m.group(3)
             yield article(id, title, text, lang)
             extracted += 1
@@ -45,7 +45,9 @@ your unix account as access to it with::
 
 import subprocess as sp
 import dbpediakit.archive as db
+import hashlib
 import logging
+import re
 from bz2 import BZ2File
 
 SQL_LIST_TABLES = (
@@ -56,6 +58,17 @@ SQL_LIST_FUNCTIONS = (
     "SELECT proname from pg_proc p, pg_namespace n"
     " WHERE p.pronamespace = n.oid and n.nspname = 'public';"
 )
+# fetch tables, functions and indexes with a single psql round-trip
+SQL_LIST_SCHEMA = (
+    "SELECT 'table', tablename, '' FROM pg_tables"
+    " WHERE schemaname = 'public'"
+    " UNION ALL"
+    " SELECT 'function', proname, '' from pg_proc p, pg_namespace n"
+    " WHERE p.pronamespace = n.oid and n.nspname = 'public'"
+    " UNION ALL"
+    " SELECT 'index', indexname, tablename FROM pg_indexes"
+    " WHERE schemaname = 'public';"
+)
 
 DATABASE = "dbpediakit"
 PSQL = "psql"
@@ -65,39 +78,248 @@ CREATE_INDEX = "CREATE INDEX {table}_{column}_idx ON {table} ({column})"
 TABLE_DEF = "-- define tables:"
 FUNC_DEF = "-- define functions:"
 
+SQL_COMMENT_PATTERN = re.compile(r'--[^\n]*')
+# optionally schema qualified identifier
+SQL_NAME = r'((?:\w+\.)?\w+)'
+CREATE_TEMP_TABLE_PATTERN = re.compile(
+    r'CREATE\s+(?:(?:GLOBAL|LOCAL)\s+)?(?:TEMP|TEMPORARY)\s+TABLE\b',
+    re.IGNORECASE)
+CREATE_TABLE_PATTERN = re.compile(
+    r'CREATE\s+(?:UNLOGGED\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?'
+    + SQL_NAME + r'\s*\(', re.IGNORECASE)
+CREATE_INDEX_PATTERN = re.compile(
+    r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:CONCURRENTLY\s+)?'
+    r'(?:IF\s+NOT\s+EXISTS\s+)?' + SQL_NAME + r'\s+ON\s+' + SQL_NAME
+    + r'\s*\(', re.IGNORECASE)
+CREATE_FUNCTION_PATTERN = re.compile(
+    r'CREATE\s+(?:OR\s+REPLACE\s+)?(?:FUNCTION|AGGREGATE)\s+' + SQL_NAME,
+    re.IGNORECASE)
+DROP_PATTERN = re.compile(
+    r'DROP\s+(TABLE|INDEX)\s+(?:IF\s+EXISTS\s+)?'
+    r'((?:\w+\.)?\w+(?:\s*,\s*(?:\w+\.)?\w+)*)(?:\s+(?:CASCADE|RESTRICT))?$',
+    re.IGNORECASE)
+# any other statement that might change the schema, including the
+# SELECT ... INTO form that creates a table
+DDL_PATTERN = re.compile(
+    r'(?:CREATE|DROP|ALTER)\b|(?:SELECT|WITH)\b.*\bINTO\b',
+    re.IGNORECASE | re.DOTALL)
+
+
+class SchemaCatalog(object):
+    """Lazily loaded cache of the tables, functions and indexes of a DB
+
+    The catalog is fetched with a single psql call the first time it is
+    accessed. Simple DDL statements issued through `execute` are applied to
+    the cached sets so that they stay in sync without querying the database
+    again. Any other statement that might change the schema, as well as
+    any script executed with `run_file`, invalidates the cache which is
+    then reloaded on next access. Call `refresh` after changing the schema
+    outside of this module.
+
+    The catalog also remembers the content hash of the SQL scripts
+    successfully executed by `check_run_if_undef` with `skip_if_run=True`.
+    Those hashes are forgotten each time the cache is invalidated.
+    """
+
+    def __init__(self, database=DATABASE):
+        self.database = database
+        self.scripts = set()
+        self._tables = None
+        self._functions = None
+        self._indexes = None
+
+    @property
+    def loaded(self):
+        return self._tables is not None
+
+    @property
+    def tables(self):
+        self._check_loaded()
+        return self._tables
+
+    @property
+    def functions(self):
+        self._check_loaded()
+        return self._functions
+
+    @property
+    def indexes(self):
+        """Mapping of index name to indexed table name"""
+        self._check_loaded()
+        return self._indexes
+
+    def _check_loaded(self):
+        if not self.loaded:
+            self._load()
+
+    def _load(self):
+        tables, functions, indexes = set(), set(), {}
+        output = select(SQL_LIST_SCHEMA, database=self.database)
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            kind, name, table = line.split('|')
+            if kind == 'table':
+                tables.add(name)
+            elif kind == 'function':
+                functions.add(name)
+            elif kind == 'index':
+                indexes[name] = table
+        self._tables, self._functions, self._indexes = (
+            tables, functions, indexes)
+
+    def refresh(self):
+        """Reload the schema from the database"""
+        self.invalidate()
+        self._load()
+
+    def invalidate(self):
+        """Discard the cached schema: it will be reloaded on next access"""
+        self._tables = self._functions = self._indexes = None
+        self.scripts.clear()
+
+    def update(self, sql):
+        """Apply the DDL statements of a successfully executed SQL string"""
+        if not self.loaded:
+            # nothing to keep in sync: the next access will load the
+            # up to date schema anyway
+            if DDL_PATTERN.search(sql):
+                self.scripts.clear()
+            return
+        if '$' in sql or "'" in sql or '"' in sql:
+            # splitting on ';' is not safe with string literals, quoted
+            # identifiers or dollar-quoted function bodies
+            if DDL_PATTERN.search(sql):
+                self.invalidate()
+            return
+        sql = SQL_COMMENT_PATTERN.sub('', sql)
+        for statement in sql.split(';'):
+            statement = statement.strip()
+            if not statement:
+                continue
+            if not self._apply(statement):
+                # schema changed in a way we do not track: reload lazily
+                self.invalidate()
+                return
+
+    def _apply(self, statement):
+        """Apply a single statement, return False if it cannot be tracked"""
+        if CREATE_TEMP_TABLE_PATTERN.match(statement):
+            # temporary tables vanish with the psql session
+            return True
+        m = CREATE_TABLE_PATTERN.match(statement)
+        if m is not None:
+            if re.search(r'\bAS\b', statement, re.IGNORECASE):
+                # CREATE TABLE ... AS: let the next access reload the schema
+                return False
+            return self._add(self._tables, m.group(1))
+        m = CREATE_INDEX_PATTERN.match(statement)
+        if m is not None:
+            index, table = _public_name(m.group(1)), _public_name(m.group(2))
+            if index is None or table is None:
+                return False
+            self._indexes[index] = table
+            return True
+        m = CREATE_FUNCTION_PATTERN.match(statement)
+        if m is not None:
+            return self._add(self._functions, m.group(1))
+        m = DROP_PATTERN.match(statement)
+        if m is not None:
+            names = [_public_name(n.strip()) for n in m.group(2).split(',')]
+            if None in names:
+                return False
+            if m.group(1).upper() == 'TABLE':
+                for table in names:
+                    self._tables.discard(table)
+                    for index, indexed in list(self._indexes.items()):
+                        if indexed == table:
+                            del self._indexes[index]
+            else:
+                for index in names:
+                    self._indexes.pop(index, None)
+            return True
+        return DDL_PATTERN.match(statement) is None
+
+    def _add(self, names, name):
+        name = _public_name(name)
+        if name is None:
+            return False
+        names.add(name)
+        return True
+
+
+def _public_name(name):
+    """Strip the public schema prefix, None for any other schema"""
+    name = name.lower()
+    if '.' in name:
+        schema, name = name.split('.', 1)
+        if schema != 'public':
+            return None
+    return name
 
-def run_file(filename, database=DATABASE):
-    logging.info("Running '%s'", filename)
-    return sp.call([PSQL, database, "-f", filename])
 
+_catalogs = {}
 
-def check_run_if_undef(filename, database=DATABASE, tables=(), functions=()):
+
+def catalog(database=DATABASE):
+    """Return the shared SchemaCatalog instance for database"""
+    if database not in _catalogs:
+        _catalogs[database] = SchemaCatalog(database=database)
+    return _catalogs[database]
+
+
+def run_file(filename, database=DATABASE, on_error_stop=False):
+    logging.info("Running '%s'", filename)
+    cmd = [PSQL, database, "-f", filename]
+    if on_error_stop:
+        # otherwise psql exits with 0 even if some statements failed
+        cmd[1:1] = ["-v", "ON_ERROR_STOP=1"]
+    code = sp.call(cmd)
+    # scripts are not parsed: the schema is reloaded on next access
+    catalog(database).invalidate()
+    return code
+
+
+def check_run_if_undef(filename, database=DATABASE, tables=(), functions=(),
+                       skip_if_run=False):
     """Conditionally run SQL script if missing relation or func
 
     The script is expected to host the matching CREATE TABLE,
     CREATE FUNCTION, CREATE AGGREGATE statements
+
+    Scripts without declared tables or functions are always run unless
+    skip_if_run is True: in that case they are skipped if the same content
+    has already been run successfully since the last schema change made
+    through this module.
     """
-    defined_tables = set(select(SQL_LIST_TABLES).split())
-    defined_functions = set(select(SQL_LIST_FUNCTIONS).split())
+    schema = catalog(database)
     with open(filename, 'r') as sql_script:
-        for line in sql_script:
-            if line.startswith(TABLE_DEF):
-                tables += tuple(
-                    t.strip() for t in line[len(TABLE_DEF):].split(","))
-            elif line.startswith(FUNC_DEF):
-                functions += tuple(
-                    f.strip() for f in line[len(FUNC_DEF):].split(","))
-
-    missing_tables = set(tables) - defined_tables
-    missing_functions = set(functions) - defined_functions
-    no_dependency = not tables and not functions
-
-    if no_dependency or missing_tables or missing_functions:
+        content = sql_script.read()
+    digest = hashlib.sha1(content).hexdigest()
+    for line in content.splitlines():
+        if line.startswith(TABLE_DEF):
+            tables += tuple(
+                t.strip() for t in line[len(TABLE_DEF):].split(","))
+        elif line.startswith(FUNC_DEF):
+            functions += tuple(
+                f.strip() for f in line[len(FUNC_DEF):].split(","))
+
+    if not tables and not functions:
+        needs_run = not skip_if_run or digest not in schema.scripts
+    else:
+        missing_tables = set(tables) - schema.tables
+        missing_functions = set(functions) - schema.functions
+        needs_run = bool(missing_tables or missing_functions)
+
+    if needs_run:
         logging.info("Running '%s' to define tables %r and functions %r",
                     filename, list(sorted(tables)), list(sorted(functions)))
-        code = run_file(filename, database=database)
+        code = run_file(filename, database=database,
+                        on_error_stop=skip_if_run)
         if code != 0:
             raise RuntimeError("Failed to execute: " + filename)
+        if skip_if_run:
+            schema.scripts.add(digest)
         return True
     else:
         logging.info("Skipping sql script '%s'", filename)
@@ -105,7 +327,12 @@ def check_run_if_undef(filename, database=DATABASE, tables=(), functions=()):
 
 
 def execute(query, database=DATABASE):
-    return sp.call([PSQL, database, "-c", query])
+    code = sp.call([PSQL, database, "-c", query])
+    if code == 0:
+        catalog(database).update(query)
+    else:
+        catalog(database).invalidate()
+    return code
 
 
 def select(query, database=DATABASE):
@@ -169,7 +396,7 @@ def check_link_table(archive_name, table, database=DATABASE,
                      columns=(('source', True), ('target', True)),
                      **extract_params):
     """Intialize a SQL table to host link tuples from dump"""
-    if table in select(SQL_LIST_TABLES).split():
+    if table in catalog(database).tables:
         logging.info("Table '%s' exists: skipping init from archive '%s'",
                      table, archive_name)
         return False
@@ -190,13 +417,14 @@ def check_link_table(archive_name, table, database=DATABASE,
     for column, index in columns:
         logging.info("Creating index on column '%s' in table '%s'",
                      column, table)
-        execute(CREATE_INDEX.format(table=table, column=column))
+        execute(CREATE_INDEX.format(table=table, column=column),
+                database=database)
     return True
 
 
 def check_text_table(archive_name, table, database=DATABASE, **extract_params):
     """Intialize a SQL table to host link tuples from dump"""
-    if table in select(SQL_LIST_TABLES).split():
+    if table in catalog(database).tables:
         logging.info("Table '%s' exists: skipping init from archive '%s'",
                      table, archive_name)
         return False
@@ -212,6 +440,8 @@ def check_text_table(archive_name, table, database=DATABASE, **extract_params):
     query += ");"
     execute(query, database=database)
 
+    # COPY only needs the UTF-8 bytes of the text
+    extract_params.setdefault('decode', False)
     tuples = db.extract_text(db.fetch(archive_name), **extract_params)
     copy(tuples, table, database=database)
     logging.info("Creating index on column '%s' in table '%s'",